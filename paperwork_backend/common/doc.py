@@ -27,6 +27,9 @@ _ = gettext.gettext
 logger = logging.getLogger(__name__)
 
 
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
 class BasicDoc(object):
     LABEL_FILE = "labels"
     DOCNAME_FORMAT = "%Y%m%d_%H%M_%S"
@@ -388,10 +391,22 @@ class BasicDoc(object):
 
     @staticmethod
     def hash_file(fs, path):
+        # SHA-256 must be kept: the hashes are stored in the index
+        # (docfilehash) and compared with the hashes of the files to import
+        if path.startswith("file://") and hasattr(hashlib, "file_digest"):
+            # Python >= 3.11: the file is read and hashed by a C loop
+            with open(fs.unsafe(path), 'rb') as fd:
+                dochash = hashlib.file_digest(fd, "sha256")
+            return int(dochash.hexdigest(), 16)
+
+        dochash = hashlib.sha256()
         with fs.open(path, 'rb') as fd:
-            content = fd.read()
-            dochash = hashlib.sha256(content).hexdigest()
-        return int(dochash, 16)
+            while True:
+                chunk = fd.read(HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                dochash.update(chunk)
+        return int(dochash.hexdigest(), 16)
 
     def clone(self):
         raise NotImplementedError()
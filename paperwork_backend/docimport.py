@@ -18,9 +18,14 @@
 Document import (PDF, images, etc)
 """
 
+import collections
+import concurrent.futures
+import functools
 import gc
 import gettext
+import itertools
 import logging
+import os
 
 from gi.repository import GLib
 from gi.repository import Gio
@@ -34,6 +39,29 @@ from . import fs
 _ = gettext.gettext
 logger = logging.getLogger(__name__)
 
+# Directory importers stop looking for importable files after this many
+# files when checking if they can import a directory
+MAX_SCANNED_FILES = 10000
+
+# Files smaller than this (in bytes) cannot be valid PDF documents. They are
+# skipped without being hashed or parsed
+PDF_MIN_SIZE = 512
+
+# Maximum number of file hashes kept in memory by PdfDirectoryImporter
+PDF_HASH_CACHE_SIZE = 10000
+
+# When importing at least this many PDF files, all the hashes known by the
+# index are fetched at once instead of querying the index for each file
+INDEX_SNAPSHOT_MIN_FILES = 16
+
+# Images are decoded by a pool of threads only when importing more than this
+# many images
+THREADED_IMG_IMPORT_MIN_FILES = 4
+
+_StatsKeys = collections.namedtuple(
+    "_StatsKeys", ["pdf", "doc", "img", "pages"]
+)
+
 IMG_MIME_TYPES = [
     ("BMP", "image/x-ms-bmp"),
     ("GIF", "image/gif"),
@@ -43,20 +71,123 @@ IMG_MIME_TYPES = [
 ]
 
 
-class ImportResult(object):
-    BASE_STATS = {
-        _("PDF"): 0,
-        _("Document(s)"): 0,
-        _("Image file(s)"): 0,
-        _("Page(s)"): 0,
-    }
+def _get_nb_import_workers(nb_files):
+    """
+    Number of threads to use when importing 'nb_files' files.
+    Can be overridden with the environment variable PAPERWORK_IMPORT_THREADS.
+    """
+    nb_workers = os.cpu_count() or 1
+    env = os.environ.get("PAPERWORK_IMPORT_THREADS")
+    if env is not None:
+        try:
+            nb_workers = int(env)
+        except ValueError:
+            logger.warning("Invalid value for PAPERWORK_IMPORT_THREADS: %s",
+                           env)
+    return max(1, min(nb_workers, nb_files))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_stats_keys():
+    """
+    Keys of ImportResult.stats. They are translated on first use, not when
+    this module is imported: the frontend configures gettext after importing
+    the backend.
+    """
+    return _StatsKeys(
+        pdf=_("PDF"),
+        doc=_("Document(s)"),
+        img=_("Image file(s)"),
+        pages=_("Page(s)"),
+    )
+
+
+def _get_hash_checker(docsearch, nb_files):
+    """
+    Return a function telling if a file hash is already in the index.
+    """
+    if nb_files < INDEX_SNAPSHOT_MIN_FILES:
+        return docsearch.is_hash_in_index
+    # fetching all the hashes is O(index size), but it is a single call to
+    # the index process
+    return docsearch.get_known_hashes().__contains__
+
+
+def _hash_pdfs(fs, file_uris):
+    """
+    Yield (file_uri, hash) for each of the specified PDF files, in the order
+    of 'file_uris'.
+
+    When there is more than one file, hashing is spread over a pool of
+    threads (hashlib releases the GIL). Only a few files are hashed ahead of
+    the caller, so if the caller stops early, it doesn't have to wait for
+    all the remaining files to be hashed. Checking the hashes against the
+    index is left to the caller.
+    """
+    if len(file_uris) <= 1:
+        for file_uri in file_uris:
+            yield (file_uri, PdfDoc.hash_file(fs, file_uri))
+        return
+    nb_workers = _get_nb_import_workers(len(file_uris))
+    with concurrent.futures.ThreadPoolExecutor(nb_workers) as pool:
+        pending = collections.deque()
+        for file_uri in file_uris:
+            pending.append(
+                (file_uri, pool.submit(PdfDoc.hash_file, fs, file_uri))
+            )
+            if len(pending) > nb_workers:
+                (pending_uri, future) = pending.popleft()
+                yield (pending_uri, future.result())
+        while len(pending) > 0:
+            (pending_uri, future) = pending.popleft()
+            yield (pending_uri, future.result())
+
+
+def _load_image(fs, file_uri):
+    """
+    Open and decode an image file. Local files are opened directly, without
+    going through Gio.
+    """
+    if file_uri.startswith("file://"):
+        with Image.open(fs.unsafe(file_uri)) as img:
+            img.load()
+        return img
+    with fs.open(file_uri, "rb") as fd:
+        img = Image.open(fd)
+        img.load()
+    return img
+
 
+def _load_images(fs, file_uris):
+    """
+    Yield the decoded images, in the order of 'file_uris'.
+
+    Bigger batches are decoded by a pool of threads (PIL decoders release
+    the GIL). Only a few images are decoded ahead of the caller, so memory
+    usage remains bounded.
+    """
+    if len(file_uris) <= THREADED_IMG_IMPORT_MIN_FILES:
+        for file_uri in file_uris:
+            yield _load_image(fs, file_uri)
+        return
+    nb_workers = _get_nb_import_workers(len(file_uris))
+    with concurrent.futures.ThreadPoolExecutor(nb_workers) as pool:
+        pending = collections.deque()
+        for file_uri in file_uris:
+            pending.append(pool.submit(_load_image, fs, file_uri))
+            if len(pending) > nb_workers:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+class ImportResult(object):
     def __init__(self,
-                 imported_file_uris=[],
+                 imported_file_uris=None,
                  select_doc=None, select_page=None,
-                 new_docs=[], upd_docs=[],
-                 new_docs_pages=[], upd_docs_pages=[],
-                 stats={}):
+                 new_docs=None, upd_docs=None,
+                 new_docs_pages=None, upd_docs_pages=None,
+                 stats=None):
         if select_doc is None and select_page is not None:
             select_doc = select_page.doc
 
@@ -64,15 +195,22 @@ class ImportResult(object):
             if select_doc.nb_pages > 0:
                 select_page = select_doc.pages[0]
 
-        self.imported_file_uris = imported_file_uris
+        self.imported_file_uris = (
+            imported_file_uris if imported_file_uris is not None else []
+        )
         self.select_doc = select_doc
         self.select_page = select_page
-        self.new_docs = new_docs
-        self.upd_docs = upd_docs
-        self.new_docs_pages = new_docs_pages
-        self.upd_docs_pages = upd_docs_pages
-        self.stats = self.BASE_STATS.copy()
-        self.stats.update(stats)
+        self.new_docs = new_docs if new_docs is not None else []
+        self.upd_docs = upd_docs if upd_docs is not None else []
+        self.new_docs_pages = (
+            new_docs_pages if new_docs_pages is not None else []
+        )
+        self.upd_docs_pages = (
+            upd_docs_pages if upd_docs_pages is not None else []
+        )
+        self.stats = dict.fromkeys(_get_stats_keys(), 0)
+        if stats:
+            self.stats.update(stats)
 
     def get(self):
         return {
@@ -108,10 +246,15 @@ class ImportResult(object):
 class BaseImporter(object):
     def __init__(self, fs, file_extensions):
         self.fs = fs
-        self.file_extensions = file_extensions
+        # str.endswith() accepts a tuple
+        self.file_extensions = tuple(ext.lower() for ext in file_extensions)
 
     @staticmethod
-    def can_import(file_uris, current_doc=None):
+    def can_import(file_uris, current_doc=None, lowered_uris=None):
+        """
+        'lowered_uris', if specified, must be the lowercased 'file_uris'. It
+        saves importers from lowercasing them again.
+        """
         assert()
 
     @staticmethod
@@ -126,18 +269,25 @@ class BaseImporter(object):
     def get_mime_types():
         return []
 
-    def check_file_type(self, file_uri):
+    def check_file_type(self, file_uri, lfile_uri=None):
         # TODO(Jflesch): should use fs.py
-        lfile_uri = file_uri.lower()
-        for extension in self.file_extensions:
-            if lfile_uri.endswith(extension):
-                return True
+        if lfile_uri is None:
+            lfile_uri = file_uri.lower()
+        if lfile_uri.endswith(self.file_extensions):
+            return True
+        mime_types = [m[1] for m in self.get_mime_types()]
+        basename = self.fs.basename(self.fs.safe(file_uri))
+        if os.path.splitext(basename)[1] != "":
+            # other extension (.tiff, .gif, ...): guess the content type from
+            # the file name only. No I/O, no content sniffing
+            (mime, uncertain) = Gio.content_type_guess(basename, None)
+            return mime in mime_types
         gfile = Gio.File.new_for_uri(file_uri)
         info = gfile.query_info(
             "standard::content-type", Gio.FileQueryInfoFlags.NONE
         )
         mime = info.get_content_type()
-        return mime in [m[1] for m in self.get_mime_types()]
+        return mime in mime_types
 
 
 class PdfImporter(BaseImporter):
@@ -148,17 +298,20 @@ class PdfImporter(BaseImporter):
     def __init__(self, fs):
         super().__init__(fs, [".pdf"])
 
-    def can_import(self, file_uris, current_doc=None):
+    def can_import(self, file_uris, current_doc=None, lowered_uris=None):
         """
         Check that the specified file looks like a PDF
         """
         if len(file_uris) <= 0:
             return False
-        for uri in file_uris:
-            uri = self.fs.safe(uri)
-            if not self.check_file_type(uri):
-                return False
-        return True
+        if lowered_uris is None:
+            lowered_uris = [uri.lower() for uri in file_uris]
+        if all(luri.endswith(self.file_extensions) for luri in lowered_uris):
+            return True
+        return all(
+            self.check_file_type(self.fs.safe(uri), luri)
+            for (uri, luri) in zip(file_uris, lowered_uris)
+        )
 
     def import_doc(self, file_uris, docsearch, current_doc=None):
         """
@@ -168,16 +321,31 @@ class PdfImporter(BaseImporter):
         docs = []
         pages = []
 
-        file_uris = [self.fs.safe(uri) for uri in file_uris]
-        imported = []
+        safe_uris = []
         for file_uri in file_uris:
-            if docsearch.is_hash_in_index(PdfDoc.hash_file(self.fs, file_uri)):
-                logger.info("Document %s already found in the index. Skipped"
-                            % (file_uri))
+            file_uri = self.fs.safe(file_uri)
+            # non-local files are left to Poppler
+            if file_uri.startswith("file://"):
+                size = os.stat(self.fs.unsafe(file_uri)).st_size
+                if size < PDF_MIN_SIZE:
+                    raise Exception(
+                        "Import of {} failed: too small to be a PDF ({} bytes)"
+                        .format(file_uri, size)
+                    )
+            safe_uris.append(file_uri)
+        file_uris = safe_uris
+
+        imported = []
+        rootdir = docsearch.rootdir
+        is_hash_in_index = _get_hash_checker(docsearch, len(file_uris))
+        for (file_uri, filehash) in _hash_pdfs(self.fs, file_uris):
+            if is_hash_in_index(filehash):
+                logger.info("Document %s already found in the index. Skipped",
+                            file_uri)
                 continue
 
-            doc = PdfDoc(self.fs, docsearch.rootdir)
-            logger.info("Importing doc '%s' ..." % file_uri)
+            doc = PdfDoc(self.fs, rootdir)
+            logger.info("Importing doc '%s' ...", file_uri)
             error = doc.import_pdf(file_uri)
             if error:
                 raise Exception("Import of {} failed: {}".format(
@@ -185,16 +353,17 @@ class PdfImporter(BaseImporter):
                 ))
             imported.append(file_uri)
             docs.append(doc)
-            pages += [p for p in doc.pages]
+            pages.extend(doc.pages)
 
+        stats_keys = _get_stats_keys()
         return ImportResult(
             imported_file_uris=imported,
             select_doc=doc, new_docs=docs,
             new_docs_pages=pages,
             stats={
-                _("PDF"): len(imported),
-                _("Document(s)"): len(imported),
-                _("Page(s)"): len(pages),
+                stats_keys.pdf: len(imported),
+                stats_keys.doc: len(imported),
+                stats_keys.pages: len(pages),
             }
         )
 
@@ -221,24 +390,72 @@ class PdfDirectoryImporter(BaseImporter):
 
     def __init__(self, fs):
         super().__init__(fs, [".pdf"])
+        # (file_uri, size, mtime, ctime) --> hash, least recently used first
+        self._hash_cache = collections.OrderedDict()
 
-    def can_import(self, file_uris, current_doc=None):
+    def can_import(self, file_uris, current_doc=None, lowered_uris=None,
+                   max_scan=MAX_SCANNED_FILES):
         """
         Check that the specified file looks like a directory containing many
-        pdf files
+        pdf files. Gives up after looking at 'max_scan' files.
         """
         if len(file_uris) <= 0:
             return False
         try:
             for file_uri in file_uris:
                 file_uri = self.fs.safe(file_uri)
-                for child in self.fs.recurse(file_uri):
+                children = itertools.islice(self.fs.walk(file_uri), max_scan)
+                for child in children:
                     if self.check_file_type(child):
                         return True
         except GLib.GError:
             pass
         return False
 
+    def _hash_files(self, files):
+        """
+        Yield (file_uri, hash) for the specified (file_uri, stat) tuples, in
+        the same order. Files too small to be valid PDFs are skipped.
+        Hashes are kept in memory: when a directory is imported again (for
+        instance after a few files have been added to it), only the new or
+        modified files are hashed again.
+        """
+        candidates = []  # (file_uri, cache key, cached hash)
+        to_hash = []
+        for (file_uri, stat) in files:
+            if stat is None:
+                # no stat available: can't check the size or use the cache
+                candidates.append((file_uri, None, None))
+                to_hash.append(file_uri)
+                continue
+            if stat.st_size < PDF_MIN_SIZE:
+                logger.info("%s is too small to be a PDF (%d bytes). Skipped",
+                            file_uri, stat.st_size)
+                continue
+            key = (file_uri, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+            filehash = self._hash_cache.get(key)
+            if filehash is not None:
+                self._hash_cache.move_to_end(key)
+            else:
+                to_hash.append(file_uri)
+            candidates.append((file_uri, key, filehash))
+
+        # _hash_pdfs() keeps the order of 'to_hash', which is also the order
+        # of the cache misses in 'candidates'
+        hashed = _hash_pdfs(self.fs, to_hash)
+        try:
+            for (file_uri, key, filehash) in candidates:
+                if filehash is None:
+                    (hashed_uri, filehash) = next(hashed)
+                    assert(hashed_uri == file_uri)
+                    if key is not None:
+                        self._hash_cache[key] = filehash
+                        if len(self._hash_cache) > PDF_HASH_CACHE_SIZE:
+                            self._hash_cache.popitem(last=False)
+                yield (file_uri, filehash)
+        finally:
+            hashed.close()
+
     def import_doc(self, file_uris, docsearch, current_doc=None):
         """
         Import the specified PDF files
@@ -249,38 +466,40 @@ class PdfDirectoryImporter(BaseImporter):
         pages = []
 
         file_uris = [self.fs.safe(uri) for uri in file_uris]
-        imported = []
+        children = []
         for file_uri in file_uris:
-            logger.info("Importing PDF from '%s'" % (file_uri))
-            idx = 0
+            logger.info("Importing PDF from '%s'", file_uri)
+            for (child, stat) in self.fs.walk(file_uri, with_stats=True):
+                if self.check_file_type(child):
+                    children.append((child, stat))
 
-            for child in self.fs.recurse(file_uri):
-                gc.collect()
-                if not self.check_file_type(child):
-                    continue
-                h = PdfDoc.hash_file(self.fs, child)
-                if docsearch.is_hash_in_index(h):
-                    logger.info(
-                        "Document %s already found in the index. Skipped",
-                        child
-                    )
-                    continue
-                imported.append(child)
-                doc = PdfDoc(self.fs, docsearch.rootdir)
-                error = doc.import_pdf(child)
-                if error:
-                    continue
-                docs.append(doc)
-                pages += [p for p in doc.pages]
-                idx += 1
+        imported = []
+        rootdir = docsearch.rootdir
+        is_hash_in_index = _get_hash_checker(docsearch, len(children))
+        for (child, filehash) in self._hash_files(children):
+            gc.collect()
+            if is_hash_in_index(filehash):
+                logger.info(
+                    "Document %s already found in the index. Skipped",
+                    child
+                )
+                continue
+            imported.append(child)
+            doc = PdfDoc(self.fs, rootdir)
+            error = doc.import_pdf(child)
+            if error:
+                continue
+            docs.append(doc)
+            pages.extend(doc.pages)
+        stats_keys = _get_stats_keys()
         return ImportResult(
             imported_file_uris=imported,
             select_doc=doc, new_docs=docs,
             new_docs_pages=pages,
             stats={
-                _("PDF"): len(docs),
-                _("Document(s)"): len(docs),
-                _("Page(s)"): sum([d.nb_pages for d in docs]),
+                stats_keys.pdf: len(docs),
+                stats_keys.doc: len(docs),
+                stats_keys.pages: sum([d.nb_pages for d in docs]),
             },
         )
 
@@ -308,17 +527,19 @@ class ImageDirectoryImporter(BaseImporter):
     def __init__(self, fs):
         super().__init__(fs, ImgDoc.IMPORT_IMG_EXTENSIONS)
 
-    def can_import(self, file_uris, current_doc=None):
+    def can_import(self, file_uris, current_doc=None, lowered_uris=None,
+                   max_scan=MAX_SCANNED_FILES):
         """
         Check that the specified file looks like a directory containing many
-        pdf files
+        image files. Gives up after looking at 'max_scan' files.
         """
         if len(file_uris) <= 0:
             return False
         try:
             for file_uri in file_uris:
                 file_uri = self.fs.safe(file_uri)
-                for child in self.fs.recurse(file_uri):
+                children = itertools.islice(self.fs.walk(file_uri), max_scan)
+                for child in children:
                     if self.check_file_type(child):
                         return True
         except GLib.GError:
@@ -348,25 +569,25 @@ class ImageDirectoryImporter(BaseImporter):
 
         for file_uri in file_uris:
             file_uri = self.fs.safe(file_uri)
-            logger.info("Importing images from '%s'" % (file_uri))
+            logger.info("Importing images from '%s'", file_uri)
 
-            for child in self.fs.recurse(file_uri):
+            for child in self.fs.walk(file_uri):
                 if ".thumb." in child:
                     # We are re-importing an old document --> ignore thumbnails
-                    logger.info("{} ignored".format(child))
+                    logger.info("%s ignored", child)
                     continue
                 if not self.check_file_type(child):
                     continue
                 imported.append(child)
-                with self.fs.open(child, "rb") as fd:
-                    img = Image.open(fd)
-                    img.load()
-                page = current_doc.add_page(img, [])
-                if new_docs == []:
-                    upd_docs_pages.append(page)
-                else:
-                    new_docs_pages.append(page)
 
+        for img in _load_images(self.fs, imported):
+            page = current_doc.add_page(img, [])
+            if new_docs == []:
+                upd_docs_pages.append(page)
+            else:
+                new_docs_pages.append(page)
+
+        stats_keys = _get_stats_keys()
         return ImportResult(
             imported_file_uris=imported,
             select_doc=current_doc, select_page=page,
@@ -374,9 +595,9 @@ class ImageDirectoryImporter(BaseImporter):
             new_docs_pages=new_docs_pages,
             upd_docs_pages=upd_docs_pages,
             stats={
-                _("Image file(s)"): len(file_uris),
-                _("Document(s)"): 0 if new_docs == [] else 1,
-                _("Page(s)"): len(new_docs_pages) + len(upd_docs_pages),
+                stats_keys.img: len(file_uris),
+                stats_keys.doc: 0 if new_docs == [] else 1,
+                stats_keys.pages: len(new_docs_pages) + len(upd_docs_pages),
             }
         )
 
@@ -404,17 +625,20 @@ class ImageImporter(BaseImporter):
     def __init__(self, fs):
         super().__init__(fs, ImgDoc.IMPORT_IMG_EXTENSIONS)
 
-    def can_import(self, file_uris, current_doc=None):
+    def can_import(self, file_uris, current_doc=None, lowered_uris=None):
         """
         Check that the specified file looks like an image supported by PIL
         """
         if len(file_uris) <= 0:
             return False
-        for file_uri in file_uris:
-            file_uri = self.fs.safe(file_uri)
-            if not self.check_file_type(file_uri):
-                return False
-        return True
+        if lowered_uris is None:
+            lowered_uris = [uri.lower() for uri in file_uris]
+        if all(luri.endswith(self.file_extensions) for luri in lowered_uris):
+            return True
+        return all(
+            self.check_file_type(self.fs.safe(uri), luri)
+            for (uri, luri) in zip(file_uris, lowered_uris)
+        )
 
     def import_doc(self, file_uris, docsearch, current_doc=None):
         """
@@ -435,12 +659,10 @@ class ImageImporter(BaseImporter):
         page = None
 
         file_uris = [self.fs.safe(uri) for uri in file_uris]
-        for file_uri in file_uris:
-            logger.info("Importing image '%s'" % (file_uri))
+        imgs = _load_images(self.fs, file_uris)
+        for (file_uri, img) in zip(file_uris, imgs):
+            logger.info("Importing image '%s'", file_uri)
 
-            with self.fs.open(file_uri, "rb") as fd:
-                img = Image.open(fd)
-                img.load()
             page = current_doc.add_page(img, [])
 
             if new_docs == []:
@@ -448,6 +670,7 @@ class ImageImporter(BaseImporter):
             else:
                 new_docs_pages.append(page)
 
+        stats_keys = _get_stats_keys()
         return ImportResult(
             imported_file_uris=file_uris,
             select_doc=current_doc, select_page=page,
@@ -455,9 +678,9 @@ class ImageImporter(BaseImporter):
             new_docs_pages=new_docs_pages,
             upd_docs_pages=upd_docs_pages,
             stats={
-                _("Image file(s)"): len(file_uris),
-                _("Document(s)"): 0 if new_docs == [] else 1,
-                _("Page(s)"): len(new_docs_pages) + len(upd_docs_pages),
+                stats_keys.img: len(file_uris),
+                stats_keys.doc: 0 if new_docs == [] else 1,
+                stats_keys.pages: len(new_docs_pages) + len(upd_docs_pages),
             }
         )
 
@@ -482,14 +705,42 @@ IMPORTERS = [
 ]
 
 
+def _get_importers_by_extension(importers):
+    """
+    Map each file extension to the importers that can handle files with this
+    extension (in the order of 'importers').
+    """
+    ext_to_importers = {}
+    for importer in importers:
+        for ext in importer.file_extensions:
+            ext_to_importers.setdefault(ext, []).append(importer)
+    return ext_to_importers
+
+
+_EXT_TO_IMPORTERS = _get_importers_by_extension(IMPORTERS)
+
+
 def get_possible_importers(file_uris, current_doc=None):
     """
     Return all the importer objects that can handle the specified files.
 
     Possible imports may vary depending on the currently active document
     """
+    lowered_uris = tuple(uri.lower() for uri in file_uris)
+
+    # Fast path: all the files have the same known extension. Every importer
+    # handling this extension can import them (directory importers accept
+    # plain files too), and no other can. Anything else (directories, mixed
+    # or unknown extensions) requires asking each importer.
+    exts = {os.path.splitext(luri)[1] for luri in lowered_uris}
+    if len(exts) == 1:
+        importers = _EXT_TO_IMPORTERS.get(exts.pop())
+        if importers is not None:
+            return list(importers)
+
     importers = []
     for importer in IMPORTERS:
-        if importer.can_import(file_uris, current_doc):
+        if importer.can_import(file_uris, current_doc,
+                               lowered_uris=lowered_uris):
             importers.append(importer)
     return importers
@@ -108,6 +108,11 @@ class DummyDocSearch(object):
         """ Do nothing """
         assert()
 
+    @staticmethod
+    def get_known_hashes(*args, **kwargs):
+        """ Do nothing """
+        assert()
+
     @staticmethod
     def guess_labels(*args, **kwargs):
         """ Do nothing """
@@ -458,6 +463,13 @@ class DocSearch(object):
         """
         return self.index.is_hash_in_index(filehash)
 
+    def get_known_hashes(self):
+        """
+        Return the hashes of all the documents in the index, so many files
+        can be checked with a single call to the index
+        """
+        return self.index.get_known_hashes()
+
     def __get_label_list(self):
         return self.index.get_label_list()
 
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import collections
 import io
 import logging
 import os
@@ -455,3 +456,85 @@ class GioFileSystem(object):
         parent = Gio.File.new_for_uri(parent_uri)
         for f in self._recurse(parent, dir_included):
             yield f.get_uri()
+
+    def walk(self, parent_uri, with_stats=False):
+        """
+        Yield the URIs of all the files below parent_uri (breadth first).
+        Directories are examined lazily, one at a time, so the caller can
+        stop early without paying for the whole tree. If parent_uri is not a
+        directory, it is the only URI yielded. Symlinks to directories are
+        not followed.
+
+        If with_stats is True, (uri, stat) tuples are yielded instead. stat
+        is the os.stat_result of the file, or None when it is not available
+        (non-local files, broken symlinks, etc).
+        """
+        if parent_uri.startswith("file://"):
+            walker = self._walk_local(self.unsafe(parent_uri))
+        else:
+            walker = self._walk_gio(Gio.File.new_for_uri(parent_uri))
+        if with_stats:
+            return walker
+        return (uri for (uri, stat) in walker)
+
+    @staticmethod
+    def _stat(path):
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
+    def _walk_local(self, parent_path):
+        # os.scandir() gets the file types from the directory entries
+        # themselves: no stat() and no Gio.File per child
+        to_examine = collections.deque([parent_path])
+        while len(to_examine) > 0:
+            parent = to_examine.popleft()
+            try:
+                entries = os.scandir(parent)
+            except OSError:
+                # assumes it's a file and not a directory
+                yield (self.safe(parent), self._stat(parent))
+                continue
+
+            with entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        to_examine.append(entry.path)
+                        continue
+                    try:
+                        # follows symlinks: we want the size and times of
+                        # the file that will actually be read
+                        stat = entry.stat()
+                    except OSError:
+                        stat = None
+                    yield (self.safe(entry.path), stat)
+
+    def _walk_gio(self, parent):
+        to_examine = collections.deque([parent])
+        while len(to_examine) > 0:
+            parent = to_examine.popleft()
+            try:
+                children = parent.enumerate_children(
+                    ",".join([
+                        Gio.FILE_ATTRIBUTE_STANDARD_NAME,
+                        Gio.FILE_ATTRIBUTE_STANDARD_TYPE,
+                    ]),
+                    Gio.FileQueryInfoFlags.NOFOLLOW_SYMLINKS,
+                    None
+                )
+            except GLib.GError:
+                # assumes it's a file and not a directory
+                yield (parent.get_uri(), None)
+                continue
+
+            for info in children:
+                child = parent.get_child(info.get_name())
+                if info.get_file_type() == Gio.FileType.DIRECTORY:
+                    to_examine.append(child)
+                else:
+                    yield (child.get_uri(), None)
@@ -749,6 +749,16 @@ class PaperworkIndex(object):
             whoosh.query.Term('docfilehash', filehash))
         return bool(results)
 
+    def get_known_hashes(self):
+        """
+        Return the hashes of all the documents in the index
+        """
+        return frozenset(
+            int(fields['docfilehash'], 16)
+            for fields in self.__searcher.all_stored_fields()
+            if fields.get('docfilehash')
+        )
+
     def get_label_list(self):
         labels = [label for label in self.labels.values()]
         labels.sort()
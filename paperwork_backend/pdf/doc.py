@@ -88,12 +88,12 @@ class PdfPages(object):
 
     def __getitem__(self, idx):
         if idx < 0:
-            idx = self.pdf.get_n_pages() + idx
+            idx = self.pdfdoc.nb_pages + idx
         return PdfPage(self.pdfdoc, idx,
                        self.on_disk_cache)
 
     def __len__(self):
-        return self.pdf.get_n_pages()
+        return self.pdfdoc.nb_pages
 
     def __iter__(self):
         return PdfPagesIterator(self.pdfdoc)